@@ -0,0 +1,540 @@
+"""
+Field Line Kernels
+==================
+
+Numba compiled kernels for tracing electric field lines. Charges are passed as an (N, 3)
+array of positions and an (N,) array of charge values so the integration loop runs entirely
+in nopython mode without touching Python objects. These should be C-contiguous so that the
+sum over charges at each step reads the positions with unit stride.
+
+Field lines are only plotted at screen resolution so the kernels work in single precision,
+all array arguments are expected to be of type FIELD_LINE_DTYPE. Only the direction of the
+force is used and so the Coulomb constant, which would overflow single precision near a
+charge, is omitted.
+
+"""
+
+__author__ = "Kristian Zarebski"
+__date__ = "2026-10-14"
+__license__ = "MIT"
+
+import math
+import typing
+import numba
+import numpy
+
+FIELD_LINE_DTYPE = numpy.float32
+
+# Squared distances are clamped to this before taking the reciprocal square root
+# so 1 / |r|^3 stays finite and a charge at the current point gives a zero rather
+# than undefined contribution, keeping the force sum free of branches
+DISTANCE_SQUARED_MINIMUM = FIELD_LINE_DTYPE(1e-24)
+
+# Numba types for the kernel signatures, declaring these explicitly means the kernels
+# are compiled (or loaded from the cache) on import and calls with any other types
+# fail rather than silently compiling a new specialisation
+_Float = numba.from_dtype(FIELD_LINE_DTYPE)
+_Vector = _Float[::1]
+_VectorArray = _Float[:, ::1]
+_VectorArrayStack = _Float[:, :, ::1]
+
+
+@numba.njit(
+    numba.boolean(
+        numba.float64,
+        numba.float64,
+        numba.float64,
+        numba.float64,
+        numba.float64,
+        numba.float64,
+        numba.float64,
+    ),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+)
+def points_at_charge(
+    fx: float,
+    fy: float,
+    fz: float,
+    dx: float,
+    dy: float,
+    dz: float,
+    sin_tolerance_squared: float,
+) -> bool:
+    """Test whether a line heading along f is within the approach tolerance of a charge at offset d.
+
+    The angle is tested through the cross product, |f x d|^2 <= sin^2(tol) |f|^2 |d|^2
+    with f . d > 0, which unlike the cosine of the angle keeps its precision at small
+    angles. The test is made in double precision, in which the products of single
+    precision components are exact. A zero force or offset is taken as reaching the
+    charge.
+    """
+    _dot = fx * dx + fy * dy + fz * dz
+    _cross_x = fy * dz - fz * dy
+    _cross_y = fz * dx - fx * dz
+    _cross_z = fx * dy - fy * dx
+    _norms_squared = (fx * fx + fy * fy + fz * fz) * (dx * dx + dy * dy + dz * dz)
+    return _norms_squared == 0.0 or (
+        _dot > 0.0
+        and _cross_x * _cross_x + _cross_y * _cross_y + _cross_z * _cross_z
+        <= sin_tolerance_squared * _norms_squared
+    )
+
+
+@numba.njit(
+    numba.int64(
+        _VectorArray, _Vector, _Vector, numba.int64, numba.int64, _Float, _VectorArray
+    ),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+)
+def integrate_field_line_into(
+    charge_positions: numpy.ndarray,
+    charge_values: numpy.ndarray,
+    line_start: numpy.ndarray,
+    length: int,
+    points_per_unit_vector: int,
+    approach_tolerance: float,
+    field_line: numpy.ndarray,
+) -> int:
+    """Trace a single field line from a start point into a preallocated output array.
+
+    Parameters
+    ----------
+    charge_positions : numpy.ndarray
+        (N, 3) array of charge positions
+    charge_values : numpy.ndarray
+        (N,) array of charge values
+    line_start : numpy.ndarray
+        position from which to start the field line
+    length : int
+        length of the field line in unit vectors
+    points_per_unit_vector : int
+        number of steps taken per unit vector
+    approach_tolerance : float
+        angle between the step and the direction to a charge below which the line
+        is considered to have reached that charge
+    field_line : numpy.ndarray
+        (length * points_per_unit_vector + 1, 3) array to write the field line points to
+
+    Returns
+    -------
+    int
+        number of points written to the field line array
+    """
+    _n_steps = length * points_per_unit_vector
+    field_line[0, 0] = line_start[0]
+    field_line[0, 1] = line_start[1]
+    field_line[0, 2] = line_start[2]
+
+    # Comparing sines avoids an arccos per charge per step
+    _sin_tolerance_squared = math.sin(numpy.float64(approach_tolerance)) ** 2
+    # The step length is loop invariant, so each step needs only a single division
+    # by the force norm whatever the value of points_per_unit_vector
+    _step_length = FIELD_LINE_DTYPE(1.0) / FIELD_LINE_DTYPE(points_per_unit_vector)
+    _n_points = 1
+
+    # Offsets (dx, dy, dz) to each charge from the current point, filled in by the
+    # force sum and reused by the charge crossing test
+    _charge_offsets = numpy.empty((charge_positions.shape[0], 3), dtype=FIELD_LINE_DTYPE)
+
+    for i in range(_n_steps):
+        _x = field_line[_n_points - 1, 0]
+        _y = field_line[_n_points - 1, 1]
+        _z = field_line[_n_points - 1, 2]
+
+        # Sum the Coulomb force from each charge at the current point
+        _fx = FIELD_LINE_DTYPE(0.0)
+        _fy = FIELD_LINE_DTYPE(0.0)
+        _fz = FIELD_LINE_DTYPE(0.0)
+        for j in range(charge_positions.shape[0]):
+            _dx = charge_positions[j, 0] - _x
+            _dy = charge_positions[j, 1] - _y
+            _dz = charge_positions[j, 2] - _z
+            _r2 = _dx * _dx + _dy * _dy + _dz * _dz
+            _inverse_r = FIELD_LINE_DTYPE(1.0) / math.sqrt(
+                max(_r2, DISTANCE_SQUARED_MINIMUM)
+            )
+            _charge_offsets[j, 0] = _dx
+            _charge_offsets[j, 1] = _dy
+            _charge_offsets[j, 2] = _dz
+            _scale = charge_values[j] * _inverse_r * _inverse_r * _inverse_r
+            _fx += _dx * _scale
+            _fy += _dy * _scale
+            _fz += _dz * _scale
+
+        # Step along the unit vector of the force
+        _force_norm = math.sqrt(_fx * _fx + _fy * _fy + _fz * _fz)
+        _step_scale = _step_length / _force_norm
+
+        # Terminate if the step points directly at any of the charges, the step
+        # is parallel to the force so the force direction is tested directly
+        if i > 1:
+            for j in range(charge_positions.shape[0]):
+                if points_at_charge(
+                    _fx,
+                    _fy,
+                    _fz,
+                    _charge_offsets[j, 0],
+                    _charge_offsets[j, 1],
+                    _charge_offsets[j, 2],
+                    _sin_tolerance_squared,
+                ):
+                    return _n_points
+
+        field_line[_n_points, 0] = _x + _fx * _step_scale
+        field_line[_n_points, 1] = _y + _fy * _step_scale
+        field_line[_n_points, 2] = _z + _fz * _step_scale
+        _n_points += 1
+
+    return _n_points
+
+
+@numba.njit(
+    _VectorArray(_VectorArray, _Vector, _Vector, numba.int64, numba.int64, _Float),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+)
+def integrate_field_line(
+    charge_positions: numpy.ndarray,
+    charge_values: numpy.ndarray,
+    line_start: numpy.ndarray,
+    length: int,
+    points_per_unit_vector: int,
+    approach_tolerance: float,
+) -> numpy.ndarray:
+    """Trace a single field line from a start point by stepping along the Coulomb force.
+
+    Returns
+    -------
+    numpy.ndarray
+        (M, 3) array of points along the field line
+    """
+    _field_line = numpy.empty(
+        (length * points_per_unit_vector + 1, 3), dtype=FIELD_LINE_DTYPE
+    )
+    _n_points = integrate_field_line_into(
+        charge_positions,
+        charge_values,
+        line_start,
+        length,
+        points_per_unit_vector,
+        approach_tolerance,
+        _field_line,
+    )
+    return _field_line[:_n_points]
+
+
+# Cash-Karp Runge-Kutta tableau, the fifth order solution is used to advance the line
+# and its difference from the embedded fourth order solution is the error estimate
+_CASH_KARP_NODES = numpy.array(
+    [
+        [0, 0, 0, 0, 0],
+        [1 / 5, 0, 0, 0, 0],
+        [3 / 40, 9 / 40, 0, 0, 0],
+        [3 / 10, -9 / 10, 6 / 5, 0, 0],
+        [-11 / 54, 5 / 2, -70 / 27, 35 / 27, 0],
+        [1631 / 55296, 175 / 512, 575 / 13824, 44275 / 110592, 253 / 4096],
+    ],
+    dtype=FIELD_LINE_DTYPE,
+)
+_CASH_KARP_WEIGHTS = numpy.array(
+    [37 / 378, 0, 250 / 621, 125 / 594, 0, 512 / 1771], dtype=FIELD_LINE_DTYPE
+)
+_CASH_KARP_ERROR_WEIGHTS = numpy.array(
+    [
+        37 / 378 - 2825 / 27648,
+        0,
+        250 / 621 - 18575 / 48384,
+        125 / 594 - 13525 / 55296,
+        -277 / 14336,
+        512 / 1771 - 1 / 4,
+    ],
+    dtype=FIELD_LINE_DTYPE,
+)
+
+# Number of times a step may be halved to meet the error tolerance, bounding the
+# smallest step to 2^-10 of the step set by points_per_unit_vector
+MAX_STEP_BISECTIONS: int = 10
+
+
+@numba.njit(
+    numba.types.UniTuple(_Float, 3)(_VectorArray, _Vector, _Float, _Float, _Float),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+)
+def field_direction(
+    charge_positions: numpy.ndarray,
+    charge_values: numpy.ndarray,
+    x: float,
+    y: float,
+    z: float,
+) -> typing.Tuple[float, float, float]:
+    """Calculate the unit vector of the Coulomb force at a point."""
+    _fx = FIELD_LINE_DTYPE(0.0)
+    _fy = FIELD_LINE_DTYPE(0.0)
+    _fz = FIELD_LINE_DTYPE(0.0)
+    for j in range(charge_positions.shape[0]):
+        _dx = charge_positions[j, 0] - x
+        _dy = charge_positions[j, 1] - y
+        _dz = charge_positions[j, 2] - z
+        _r2 = _dx * _dx + _dy * _dy + _dz * _dz
+        _inverse_r = FIELD_LINE_DTYPE(1.0) / math.sqrt(
+            max(_r2, DISTANCE_SQUARED_MINIMUM)
+        )
+        _scale = charge_values[j] * _inverse_r * _inverse_r * _inverse_r
+        _fx += _dx * _scale
+        _fy += _dy * _scale
+        _fz += _dz * _scale
+
+    _force_norm = math.sqrt(_fx * _fx + _fy * _fy + _fz * _fz)
+    return _fx / _force_norm, _fy / _force_norm, _fz / _force_norm
+
+
+@numba.njit(
+    numba.int64(
+        _VectorArray,
+        _Vector,
+        _Vector,
+        numba.int64,
+        numba.int64,
+        _Float,
+        _Float,
+        _VectorArray,
+    ),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+)
+def integrate_field_line_adaptive_into(
+    charge_positions: numpy.ndarray,
+    charge_values: numpy.ndarray,
+    line_start: numpy.ndarray,
+    length: int,
+    points_per_unit_vector: int,
+    approach_tolerance: float,
+    error_tolerance: float,
+    field_line: numpy.ndarray,
+) -> int:
+    """Trace a field line with adaptive Cash-Karp Runge-Kutta steps into a preallocated array.
+
+    Points are written each time the line advances 1 / points_per_unit_vector along its
+    length, which is also the largest step allowed, so the plotted resolution and the
+    line length are those of the fixed step kernel. A step is accepted when the
+    difference between the fourth and fifth order solutions is within error_tolerance,
+    otherwise it is halved and retried, down to 2^-MAX_STEP_BISECTIONS of the largest
+    step. Halved steps are taken between the written points. After a step accepted at
+    the first attempt the next step is four times larger. The line ends when it
+    reaches the given length, heads directly towards a charge or fills the output
+    array.
+
+    Parameters
+    ----------
+    charge_positions : numpy.ndarray
+        (N, 3) array of charge positions
+    charge_values : numpy.ndarray
+        (N,) array of charge values
+    line_start : numpy.ndarray
+        position from which to start the field line
+    length : int
+        length of the field line in unit vectors
+    points_per_unit_vector : int
+        number of points written per unit vector, the largest step size being the
+        spacing between them
+    approach_tolerance : float
+        angle between the line and the direction to a charge below which the line
+        is considered to have reached that charge
+    error_tolerance : float
+        largest accepted error estimate in the position after a step
+    field_line : numpy.ndarray
+        (length * points_per_unit_vector + 1, 3) array to write the field line points to
+
+    Returns
+    -------
+    int
+        number of points written to the field line array
+    """
+    field_line[0, 0] = line_start[0]
+    field_line[0, 1] = line_start[1]
+    field_line[0, 2] = line_start[2]
+
+    _sin_tolerance_squared = math.sin(numpy.float64(approach_tolerance)) ** 2
+    _max_step = FIELD_LINE_DTYPE(1.0) / FIELD_LINE_DTYPE(points_per_unit_vector)
+    _min_step = _max_step / FIELD_LINE_DTYPE(2**MAX_STEP_BISECTIONS)
+    _n_output_points = min(field_line.shape[0], length * points_per_unit_vector + 1)
+    _step = _max_step
+    _n_points = 1
+
+    # Distance along the line remaining until the next point is written, steps are cut
+    # short so they end exactly on each written point
+    _remaining = _max_step
+
+    _x = field_line[0, 0]
+    _y = field_line[0, 1]
+    _z = field_line[0, 2]
+
+    # Direction of the field at each stage of the step
+    _stages = numpy.empty((6, 3), dtype=FIELD_LINE_DTYPE)
+
+    while _n_points < _n_output_points:
+        # The first stage does not depend on the step size so is shared by retries
+        _stages[0, 0], _stages[0, 1], _stages[0, 2] = field_direction(
+            charge_positions, charge_values, _x, _y, _z
+        )
+
+        # Terminate if the line points directly at any of the charges, ending the
+        # line at the current position if it lies between written points
+        if _n_points > 2:
+            for j in range(charge_positions.shape[0]):
+                if points_at_charge(
+                    _stages[0, 0],
+                    _stages[0, 1],
+                    _stages[0, 2],
+                    charge_positions[j, 0] - _x,
+                    charge_positions[j, 1] - _y,
+                    charge_positions[j, 2] - _z,
+                    _sin_tolerance_squared,
+                ):
+                    if _remaining < _max_step:
+                        field_line[_n_points, 0] = _x
+                        field_line[_n_points, 1] = _y
+                        field_line[_n_points, 2] = _z
+                        _n_points += 1
+                    return _n_points
+
+        _trial_step = min(_step, _remaining)
+        _halved = False
+        while True:
+            for s in range(1, 6):
+                _px = _x
+                _py = _y
+                _pz = _z
+                for m in range(s):
+                    _px += _trial_step * _CASH_KARP_NODES[s, m] * _stages[m, 0]
+                    _py += _trial_step * _CASH_KARP_NODES[s, m] * _stages[m, 1]
+                    _pz += _trial_step * _CASH_KARP_NODES[s, m] * _stages[m, 2]
+                _stages[s, 0], _stages[s, 1], _stages[s, 2] = field_direction(
+                    charge_positions, charge_values, _px, _py, _pz
+                )
+
+            _ex = FIELD_LINE_DTYPE(0.0)
+            _ey = FIELD_LINE_DTYPE(0.0)
+            _ez = FIELD_LINE_DTYPE(0.0)
+            for s in range(6):
+                _ex += _CASH_KARP_ERROR_WEIGHTS[s] * _stages[s, 0]
+                _ey += _CASH_KARP_ERROR_WEIGHTS[s] * _stages[s, 1]
+                _ez += _CASH_KARP_ERROR_WEIGHTS[s] * _stages[s, 2]
+
+            if (
+                _trial_step * math.sqrt(_ex * _ex + _ey * _ey + _ez * _ez)
+                <= error_tolerance
+                or _trial_step <= _min_step
+            ):
+                break
+
+            _trial_step = _trial_step * FIELD_LINE_DTYPE(0.5)
+            _halved = True
+
+        _sx = FIELD_LINE_DTYPE(0.0)
+        _sy = FIELD_LINE_DTYPE(0.0)
+        _sz = FIELD_LINE_DTYPE(0.0)
+        for s in range(6):
+            _sx += _CASH_KARP_WEIGHTS[s] * _stages[s, 0]
+            _sy += _CASH_KARP_WEIGHTS[s] * _stages[s, 1]
+            _sz += _CASH_KARP_WEIGHTS[s] * _stages[s, 2]
+
+        _x = _x + _trial_step * _sx
+        _y = _y + _trial_step * _sy
+        _z = _z + _trial_step * _sz
+        _remaining = _remaining - _trial_step
+
+        if _remaining <= 0.0:
+            field_line[_n_points, 0] = _x
+            field_line[_n_points, 1] = _y
+            field_line[_n_points, 2] = _z
+            _n_points += 1
+            _remaining = _max_step
+
+        # Keep a halved step for the next step, otherwise grow it again
+        if _halved:
+            _step = _trial_step
+        else:
+            _step = min(FIELD_LINE_DTYPE(4.0) * _step, _max_step)
+
+    return _n_points
+
+
+@numba.njit(
+    numba.void(
+        _VectorArray,
+        _Vector,
+        _VectorArray,
+        numba.int64,
+        numba.int64,
+        _Float,
+        numba.boolean,
+        _Float,
+        _VectorArrayStack,
+        numba.int64[::1],
+    ),
+    cache=True,
+    fastmath=True,
+    nogil=True,
+    parallel=True,
+)
+def all_field_lines(
+    charge_positions: numpy.ndarray,
+    charge_values: numpy.ndarray,
+    line_starts: numpy.ndarray,
+    length: int,
+    points_per_unit_vector: int,
+    approach_tolerance: float,
+    adaptive_step: bool,
+    error_tolerance: float,
+    field_lines: numpy.ndarray,
+    field_line_lengths: numpy.ndarray,
+) -> None:
+    """Trace a field line from each start point in parallel.
+
+    Each line is written to its own row of the output so the lines can be traced
+    independently across threads.
+
+    Parameters
+    ----------
+    line_starts : numpy.ndarray
+        (M, 3) array of start points, one per field line
+    adaptive_step : bool
+        whether to trace lines with adaptive Cash-Karp steps rather than fixed Euler steps
+    error_tolerance : float
+        largest accepted error estimate per step when using adaptive steps
+    field_lines : numpy.ndarray
+        (M, length * points_per_unit_vector + 1, 3) array to write the field lines to
+    field_line_lengths : numpy.ndarray
+        (M,) array to write the number of points in each field line to
+    """
+    for i in numba.prange(line_starts.shape[0]):
+        if adaptive_step:
+            field_line_lengths[i] = integrate_field_line_adaptive_into(
+                charge_positions,
+                charge_values,
+                line_starts[i],
+                length,
+                points_per_unit_vector,
+                approach_tolerance,
+                error_tolerance,
+                field_lines[i],
+            )
+        else:
+            field_line_lengths[i] = integrate_field_line_into(
+                charge_positions,
+                charge_values,
+                line_starts[i],
+                length,
+                points_per_unit_vector,
+                approach_tolerance,
+                field_lines[i],
+            )
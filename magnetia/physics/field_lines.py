@@ -14,12 +14,20 @@ __date__ = "2022-10-25"
 __license__ = "MIT"
 
 import dataclasses
+import threading
 import numpy
 import typing
 import scipy.constants as sp_const
 import magnetia.types as mg_types
+import magnetia.physics._kernels as mg_kernels
 
 CHARGE_VISUAL_RADIUS: float = 0.2
+COULOMB_K: float = 1.0 / (4.0 * sp_const.pi * sp_const.epsilon_0)
+
+# The parallel kernel may only be run by one thread at a time, as Numba's default
+# workqueue threading layer fails if a parallel region is launched concurrently,
+# e.g. by the worker threads of two Bokeh sessions
+_PARALLEL_KERNEL_LOCK = threading.Lock()
 
 
 @dataclasses.dataclass
@@ -30,6 +38,74 @@ class PointCharge:
     charge: numpy.float64
 
 
+def charges_to_arrays(
+    electric_charges: typing.List[PointCharge],
+) -> typing.Tuple[mg_types.Float64_3DVectorArray, mg_types.Float64_ScalarArray]:
+    """Convert a list of point charges into position and charge arrays.
+
+    Parameters
+    ----------
+    electric_charges : typing.List[PointCharge]
+        list of charges to convert
+
+    Returns
+    -------
+    typing.Tuple[mg_types.Float64_3DVectorArray, mg_types.Float64_ScalarArray]
+        (N, 3) array of charge positions and (N,) array of charge values
+    """
+    _charge_positions: mg_types.Float64_3DVectorArray = numpy.array(
+        [charge.position for charge in electric_charges], dtype=numpy.float64
+    ).reshape(-1, 3)
+    _charge_values: mg_types.Float64_ScalarArray = numpy.array(
+        [charge.charge for charge in electric_charges], dtype=numpy.float64
+    )
+    return _charge_positions, _charge_values
+
+
+def coulomb_force_soa(
+    charge_positions: mg_types.Float64_3DVectorArray,
+    charge_values: mg_types.Float64_ScalarArray,
+    coulomb_k: float,
+    field_position: mg_types.Float64_3DVector,
+) -> mg_types.Float64_3DVector:
+    """
+    Calculate the Coulomb Force due to a set of charges held as arrays at a position.
+
+    Parameters
+    ----------
+    charge_positions : mg_types.Float64_3DVectorArray
+        (N, 3) array of charge positions
+    charge_values : mg_types.Float64_ScalarArray
+        (N,) array of charge values
+    coulomb_k : float
+        Coulomb constant 1/(4 pi epsilon_0)
+    field_position : mg_types.Float64_3DVector
+        position at which to calculate the force
+
+    Returns
+    -------
+    mg_types.Float64_3DVector
+        Coulomb Force expressed as a vector
+    """
+    _distance_vecs: mg_types.Float64_3DVectorArray = charge_positions - numpy.ravel(
+        field_position
+    )
+    _distance_sq: mg_types.Float64_ScalarArray = numpy.einsum(
+        "ij,ij->i", _distance_vecs, _distance_vecs
+    )
+
+    # Charges located at the field position have a zero distance vector, bounding the
+    # squared distance below as the kernels do makes their contribution zero without
+    # masking them out
+    _inv_distance_cubed: mg_types.Float64_ScalarArray = (
+        numpy.maximum(_distance_sq, mg_kernels.DISTANCE_SQUARED_MINIMUM) ** -1.5
+    )
+
+    return coulomb_k * numpy.einsum(
+        "ij,i->j", _distance_vecs, charge_values * _inv_distance_cubed
+    )
+
+
 def coulomb_force(
     electric_charges: typing.List[PointCharge],
     field_position: mg_types.Float64_3DVector,
@@ -49,27 +125,61 @@ def coulomb_force(
     mg_types.Float64_3DVector
         Coulomb Force expressed as a vector
     """
-    k = numpy.power(4 * sp_const.pi * sp_const.epsilon_0, -1)
     _coulomb_force_vec: mg_types.Float64_3DVector = numpy.zeros(3)
 
     for charge in electric_charges:
         _distance_vec: mg_types.Float64_3DVector = charge.position - field_position
-        if numpy.linalg.norm(_distance_vec) == 0:
+        _distance_sq: numpy.float64 = _distance_vec @ _distance_vec
+        if _distance_sq == 0:
             continue
-        _unit_vec: mg_types.Float64_3DVector = _distance_vec / numpy.linalg.norm(
-            _distance_vec
-        )
+        # |r|^3 = r^2 sqrt(r^2) so the unit vector and inverse square fold into one factor
         _coulomb_force_vec += (
-            _unit_vec * k * charge.charge / numpy.dot(_distance_vec, _distance_vec)
-        )
+            COULOMB_K * charge.charge / (_distance_sq * numpy.sqrt(_distance_sq))
+        ) * _distance_vec
 
     return _coulomb_force_vec
 
 
+def get_line_start_points_from_positions(
+    charge_positions: mg_types.Float64_3DVectorArray, n_lines: int
+) -> mg_types.Float64_3DVectorArray:
+    """Create an array of field line start points around each of a set of charge positions.
+
+    Parameters
+    ----------
+    charge_positions : mg_types.Float64_3DVectorArray
+        (N, 3) array of positions of the charges to draw field lines from
+    n_lines : int
+        number of lines to plot for each charge
+
+    Returns
+    -------
+    mg_types.Float64_3DVectorArray
+        (N * 2 * (n_lines // 2), 3) array of cartesian coordinates marking the start
+        positions, grouped by charge
+    """
+    _n_half: int = n_lines // 2
+    _angles: mg_types.Float64_ScalarArray = numpy.arange(_n_half) * (2 * sp_const.pi / n_lines)
+
+    # Points are mirrored through the charge to give the second half of the circle
+    _offsets = numpy.empty((2 * _n_half, 2))
+    _offsets[:_n_half, 0] = CHARGE_VISUAL_RADIUS * numpy.sin(_angles)
+    _offsets[:_n_half, 1] = CHARGE_VISUAL_RADIUS * numpy.cos(_angles)
+    _offsets[_n_half:] = -_offsets[:_n_half]
+
+    # Start points for all charges are created in one broadcast, lying in the z = 0 plane
+    _line_start_points = numpy.zeros((len(charge_positions), 2 * _n_half, 3))
+    _line_start_points[..., :2] = (
+        numpy.asarray(charge_positions)[:, numpy.newaxis, :2] + _offsets[numpy.newaxis]
+    )
+
+    return _line_start_points.reshape(-1, 3)
+
+
 def get_line_start_points(
     electric_charge: PointCharge, n_lines: int
-) -> typing.List[mg_types.Float64_3DVector]:
-    """Create a list of field line start points for a given point charge.
+) -> mg_types.Float64_3DVectorArray:
+    """Create an array of field line start points for a given point charge.
 
     Parameters
     ----------
@@ -80,37 +190,12 @@ def get_line_start_points(
 
     Returns
     -------
-    typing.List[mg_types.Float64_3DVector]
-        list of cartesian coordinates marking the start positions
+    mg_types.Float64_3DVectorArray
+        (2 * (n_lines // 2), 3) array of cartesian coordinates marking the start positions
     """
-    _angle_interval: numpy.float64 = 2 * sp_const.pi / n_lines
-    _line_start_points = [
-        numpy.array(
-            [
-                electric_charge.position[0]
-                + CHARGE_VISUAL_RADIUS * numpy.sin(i * _angle_interval),
-                electric_charge.position[1]
-                + CHARGE_VISUAL_RADIUS * numpy.cos(i * _angle_interval),
-                0,
-            ]
-        )
-        for i in range(n_lines // 2)
-    ]
-
-    _line_start_points += [
-        numpy.array(
-            [
-                electric_charge.position[0]
-                - CHARGE_VISUAL_RADIUS * numpy.sin(i * _angle_interval),
-                electric_charge.position[1]
-                - CHARGE_VISUAL_RADIUS * numpy.cos(i * _angle_interval),
-                0,
-            ]
-        )
-        for i in range(n_lines // 2)
-    ]
-
-    return _line_start_points
+    return get_line_start_points_from_positions(
+        numpy.asarray(electric_charge.position)[numpy.newaxis], n_lines
+    )
 
 
 def angle_between_vectors(vector_1: mg_types.Float64_3DVector, vector_2: mg_types.Float64_3DVector) -> numpy.float64:
@@ -122,15 +207,16 @@ def check_if_crosses_charge(
     new_coordinate: mg_types.Float64_3DVector,
     tolerance: numpy.float64 = 5e-2,
 ) -> bool:
-    for electric_charge in electric_charges:
-        _new_line_vec: mg_types.Float64_3DVector = new_coordinate - old_coordinate
-        _to_charg_vec: mg_types.Float64_3DVector = electric_charge.position - old_coordinate
+    _charge_positions, _ = charges_to_arrays(electric_charges)
+    _new_line_vec: mg_types.Float64_3DVector = numpy.ravel(new_coordinate - old_coordinate)
+    _to_charge_vecs: mg_types.Float64_3DVectorArray = _charge_positions - numpy.ravel(old_coordinate)
 
-        _angle: numpy.float64 = angle_between_vectors(_new_line_vec, _to_charg_vec)
+    _angles: mg_types.Float64_ScalarArray = numpy.arccos(
+        _to_charge_vecs @ _new_line_vec
+        / (numpy.linalg.norm(_to_charge_vecs, axis=1) * numpy.linalg.norm(_new_line_vec))
+    )
 
-        if numpy.any(numpy.isnan(_angle)) or _angle <= tolerance:
-            return True
-    return False
+    return bool(numpy.any(numpy.isnan(_angles) | (_angles <= tolerance)))
 
 
 def create_field_line(
@@ -139,52 +225,150 @@ def create_field_line(
     length: int = 100,
     points_per_unit_vector: int=1,
     approach_tolerance: float=1E-1
-) -> mg_types.Float64_3DVectorArray:
-    _field_line: typing.List[mg_types.Float64_3DVector] = numpy.array([line_start])
+) -> mg_types.Float32_3DVectorArray:
+    _charge_positions, _charge_values = charges_to_arrays(electric_charges)
+    return mg_kernels.integrate_field_line(
+        _charge_positions.astype(mg_kernels.FIELD_LINE_DTYPE),
+        _charge_values.astype(mg_kernels.FIELD_LINE_DTYPE),
+        numpy.asarray(line_start, dtype=mg_kernels.FIELD_LINE_DTYPE),
+        length,
+        points_per_unit_vector,
+        mg_kernels.FIELD_LINE_DTYPE(approach_tolerance),
+    )
+
+
+def field_line_buffer_from_arrays(
+    charge_positions: mg_types.Float64_3DVectorArray,
+    charge_values: mg_types.Float64_ScalarArray,
+    n_lines_per_charge: int = 20,
+    length: int = 20,
+    points_per_unit_vector: int = 1,
+    approach_tolerance: float = 1e-1,
+    adaptive_step: bool = False,
+    error_tolerance: float = 1e-4,
+) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """Trace field lines from each negative charge into a single contiguous buffer.
 
-    for i in range(length * points_per_unit_vector):
+    Parameters
+    ----------
+    charge_positions : mg_types.Float64_3DVectorArray
+        (N, 3) array of charge positions
+    charge_values : mg_types.Float64_ScalarArray
+        (N,) array of charge values
+    n_lines_per_charge : int, optional
+        number of field lines to draw from each negative charge, by default 20
+    length : int, optional
+        length of each field line in unit vectors, by default 20
+    points_per_unit_vector : int, optional
+        number of steps taken per unit vector, by default 1
+    approach_tolerance : float, optional
+        angle between a line and the direction to a charge below which the line
+        is considered to have reached that charge, by default 1e-1
+    adaptive_step : bool, optional
+        trace lines with adaptive Cash-Karp Runge-Kutta steps, no larger than
+        1 / points_per_unit_vector, rather than fixed Euler steps, by default False
+    error_tolerance : float, optional
+        largest accepted error estimate per step when using adaptive steps, by default 1e-4
 
-        # Obtain the force at the given point and then find the unit vector
-        _force_vector: mg_types.Float64_3DVector = coulomb_force(
-            electric_charges, _field_line[-1]
-        )
-        _unit_vec: mg_types.Float64_3DVector = _force_vector / numpy.linalg.norm(
-            _force_vector
+    Returns
+    -------
+    typing.Tuple[numpy.ndarray, numpy.ndarray]
+        (L, S, 3) array of points along each of the L field lines and (L,) array
+        of the number of points in each line, points beyond which are unset
+    """
+    # Create the starting points for each field line, these being spaced
+    # evenly across the angle 2pi. Only plot field lines from negative charges
+    _line_starts: mg_types.Float64_3DVectorArray = get_line_start_points_from_positions(
+        charge_positions[charge_values <= 0], n_lines_per_charge
+    )
+
+    # Each field line is traced independently into its own row
+    _field_lines: mg_types.Float32_3DVectorArray = numpy.empty(
+        (_line_starts.shape[0], length * points_per_unit_vector + 1, 3),
+        dtype=mg_kernels.FIELD_LINE_DTYPE,
+    )
+    _field_line_lengths = numpy.empty(_line_starts.shape[0], dtype=numpy.int64)
+
+    with _PARALLEL_KERNEL_LOCK:
+        mg_kernels.all_field_lines(
+            numpy.ascontiguousarray(charge_positions, dtype=mg_kernels.FIELD_LINE_DTYPE),
+            numpy.ascontiguousarray(charge_values, dtype=mg_kernels.FIELD_LINE_DTYPE),
+            _line_starts.astype(mg_kernels.FIELD_LINE_DTYPE),
+            length,
+            points_per_unit_vector,
+            mg_kernels.FIELD_LINE_DTYPE(approach_tolerance),
+            adaptive_step,
+            mg_kernels.FIELD_LINE_DTYPE(error_tolerance),
+            _field_lines,
+            _field_line_lengths,
         )
 
-        _new_coord: mg_types.Float64_3DVector = (_field_line[-1] + (1 / points_per_unit_vector) * _unit_vec)[
-            numpy.newaxis, ...
-        ]
-
-        if check_if_crosses_charge(
-            electric_charges, _field_line[-1], _new_coord, approach_tolerance
-        ) and i > 1:
-            return _field_line
-
-        # Append the next point in the field line taken to be the current
-        # point plus an interval of the unit vector
-        _field_line = numpy.append(
-            _field_line,
-            _new_coord,
-            axis=0,
-        )
+    return _field_lines, _field_line_lengths
 
-    return _field_line
 
+def field_lines_from_arrays(
+    charge_positions: mg_types.Float64_3DVectorArray,
+    charge_values: mg_types.Float64_ScalarArray,
+    n_lines_per_charge: int = 20,
+    length: int = 20,
+    points_per_unit_vector: int = 1,
+    approach_tolerance: float = 1e-1,
+    adaptive_step: bool = False,
+    error_tolerance: float = 1e-4,
+) -> typing.List[mg_types.Float32_3DVectorArray]:
+    """Create field lines from each negative charge, with charges held as arrays.
 
-def field_lines_from_charges(
-    electric_charges: PointCharge, n_lines_per_charge: int = 20, length: int = 20, points_per_unit_vector: int=1, approach_tolerance: float=1E-1
-) -> typing.List[mg_types.Float64_3DVectorArray]:
-    _field_lines: typing.List[mg_types.Float64_3DVectorArray] = []
+    Parameters
+    ----------
+    charge_positions : mg_types.Float64_3DVectorArray
+        (N, 3) array of charge positions
+    charge_values : mg_types.Float64_ScalarArray
+        (N,) array of charge values
+    n_lines_per_charge : int, optional
+        number of field lines to draw from each negative charge, by default 20
+    length : int, optional
+        length of each field line in unit vectors, by default 20
+    points_per_unit_vector : int, optional
+        number of steps taken per unit vector, by default 1
+    approach_tolerance : float, optional
+        angle between a line and the direction to a charge below which the line
+        is considered to have reached that charge, by default 1e-1
+    adaptive_step : bool, optional
+        trace lines with adaptive Cash-Karp Runge-Kutta steps, no larger than
+        1 / points_per_unit_vector, rather than fixed Euler steps, by default False
+    error_tolerance : float, optional
+        largest accepted error estimate per step when using adaptive steps, by default 1e-4
 
-    for electric_charge in electric_charges:
-        # Only plot field lines from positive charges
-        if electric_charge.charge > 0:
-            continue
+    Returns
+    -------
+    typing.List[mg_types.Float32_3DVectorArray]
+        list of (M, 3) arrays of points along each field line
+    """
+    _field_lines, _field_line_lengths = field_line_buffer_from_arrays(
+        charge_positions,
+        charge_values,
+        n_lines_per_charge,
+        length,
+        points_per_unit_vector,
+        approach_tolerance,
+        adaptive_step,
+        error_tolerance,
+    )
+
+    return [
+        field_line[:n_points]
+        for field_line, n_points in zip(_field_lines, _field_line_lengths)
+    ]
 
-        # Create a field line from each starting point, these being spaced
-        # evenly across the angle 2pi
-        for line_start in get_line_start_points(electric_charge, n_lines_per_charge):
-            _field_lines.append(create_field_line(electric_charges, line_start, length, points_per_unit_vector, approach_tolerance))
 
-    return _field_lines
+def field_lines_from_charges(
+    electric_charges: PointCharge, n_lines_per_charge: int = 20, length: int = 20, points_per_unit_vector: int=1, approach_tolerance: float=1E-1, adaptive_step: bool=False
+) -> typing.List[mg_types.Float32_3DVectorArray]:
+    return field_lines_from_arrays(
+        *charges_to_arrays(electric_charges),
+        n_lines_per_charge,
+        length,
+        points_per_unit_vector,
+        approach_tolerance,
+        adaptive_step,
+    )
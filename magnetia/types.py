@@ -1,4 +1,6 @@
 import nptyping
 
 Float64_3DVector = nptyping.NDArray[nptyping.Shape["3"], nptyping.Float64]
-Float64_3DVectorArray = nptyping.NDArray[nptyping.Shape["*,3"], nptyping.Float64]
\ No newline at end of file
+Float64_3DVectorArray = nptyping.NDArray[nptyping.Shape["*,3"], nptyping.Float64]
+Float64_ScalarArray = nptyping.NDArray[nptyping.Shape["*"], nptyping.Float64]
+Float32_3DVectorArray = nptyping.NDArray[nptyping.Shape["*,3"], nptyping.Float32]
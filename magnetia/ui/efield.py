@@ -10,6 +10,8 @@ __author__ = "Kristian Zarebski"
 __date__ = "2022-10-26"
 __license__ = "MIT"
 
+import concurrent.futures
+import functools
 import typing
 import loguru
 import sys
@@ -27,87 +29,64 @@ N_POINTS_PER_UNIT_VECTOR_INTERVAL: typing.Tuple[int, int, int] = (1, 10, 1)
 FIELD_LINE_LENGTH_INTERVAL: typing.Tuple[int, int, int] = (10, 100, 10)
 APPROACH_TOLERANCE_INTERVAL: typing.Tuple[int, int, int] = (1, 10, 1)
 
+# Period in milliseconds over which widget changes are combined into a single update
+UPDATE_DEBOUNCE_PERIOD: int = 50
+
+
+def create_interval_slider(
+    interval: typing.Tuple[int, int, int], title: str
+) -> bokeh.models.Slider:
+    """Create a slider spanning an interval, starting one step above its minimum"""
+    return bokeh.models.Slider(
+        start=interval[0],
+        end=interval[1],
+        value=interval[0] + interval[2],
+        step=interval[2],
+        title=title,
+    )
+
+
 # The application data dictionary contains the state of all widget/plot objects
 # and is where values are updated
 application_data: typing.Dict[str, typing.Any] = {
-    # Create Point Charge objects for field line calculations
-    "charges": [
-        mg_fl.PointCharge(
-            numpy.array([-10 + i * 2, -10 + i * 2, 0]), -1 if i % 2 == 0 else 1
-        )
-        for i in range(N_CHARGES_INTERVAL[1])
-    ],
-    # Create slider widgets for the X, Y positions for each charge
-    "charge_position_sliders": {
-        "x": [
-            bokeh.models.Slider(
-                start=-10,
-                end=10,
-                value=-10 + i * 2,
-                step=1,
-                title=f"Q{i}x",
-            )
-            for i in range(N_CHARGES_INTERVAL[1])
-        ],
-        "y": [
-            bokeh.models.Slider(
-                start=-10,
-                end=10,
-                value=-10 + i * 2,
-                step=1,
-                title=f"Q{i}y",
-            )
-            for i in range(N_CHARGES_INTERVAL[1])
-        ],
-    },
-    # Create check box for choosing if charge is positive or negative
-    "polarity_checkboxes": [
-        bokeh.models.RadioButtonGroup(
-            labels=["-", "+"], active=0 if i % 2 == 0 else 1, orientation="vertical"
-        )
-        for i in range(N_CHARGES_INTERVAL[1])
-    ],
+    # Charge positions and values for field line calculations, held as arrays
+    # which are updated in place and passed straight to the field line kernel
+    "charge_positions": numpy.array(
+        [[-10 + i * 2, -10 + i * 2, 0] for i in range(N_CHARGES_INTERVAL[1])],
+        dtype=numpy.float64,
+    ),
+    "charge_values": numpy.array(
+        [-1 if i % 2 == 0 else 1 for i in range(N_CHARGES_INTERVAL[1])],
+        dtype=numpy.float64,
+    ),
+    # Slider widgets for the X, Y positions and check boxes for choosing if a
+    # charge is positive or negative, these are only created once a charge is shown
+    "charge_position_sliders": {"x": [], "y": []},
+    "polarity_checkboxes": [],
     # Slider to set number of charges to display
-    "n_charges_slider": bokeh.models.Slider(
-        start=N_CHARGES_INTERVAL[0],
-        end=N_CHARGES_INTERVAL[1],
-        value=N_CHARGES_INTERVAL[0] + N_CHARGES_INTERVAL[2],
-        step=N_CHARGES_INTERVAL[2],
-        title="Number of Charges",
+    "n_charges_slider": create_interval_slider(
+        N_CHARGES_INTERVAL, "Number of Charges"
     ),
     # Slider to set the resolution of the field lines
-    "n_points_per_unit_vector_slider": bokeh.models.Slider(
-        start=N_POINTS_PER_UNIT_VECTOR_INTERVAL[0],
-        end=N_POINTS_PER_UNIT_VECTOR_INTERVAL[1],
-        value=N_POINTS_PER_UNIT_VECTOR_INTERVAL[0]
-        + N_POINTS_PER_UNIT_VECTOR_INTERVAL[2],
-        step=N_POINTS_PER_UNIT_VECTOR_INTERVAL[2],
-        title="Resolution",
+    "n_points_per_unit_vector_slider": create_interval_slider(
+        N_POINTS_PER_UNIT_VECTOR_INTERVAL, "Resolution"
     ),
     # Slider to set the number of field lines from each negative charge
-    "field_lines_per_charge_slider": bokeh.models.Slider(
-        start=FIELD_LINES_PER_CHARGE_INTERVAL[0],
-        end=FIELD_LINES_PER_CHARGE_INTERVAL[1],
-        value=FIELD_LINES_PER_CHARGE_INTERVAL[0] + FIELD_LINES_PER_CHARGE_INTERVAL[2],
-        step=FIELD_LINES_PER_CHARGE_INTERVAL[2],
-        title="Number of Field Lines per Charge",
+    "field_lines_per_charge_slider": create_interval_slider(
+        FIELD_LINES_PER_CHARGE_INTERVAL, "Number of Field Lines per Charge"
     ),
     # Slider to set the length of the field lines
-    "field_line_length_slider": bokeh.models.Slider(
-        start=FIELD_LINE_LENGTH_INTERVAL[0],
-        end=FIELD_LINE_LENGTH_INTERVAL[1],
-        value=FIELD_LINE_LENGTH_INTERVAL[0] + FIELD_LINE_LENGTH_INTERVAL[2],
-        step=FIELD_LINE_LENGTH_INTERVAL[2],
-        title="Field Line Length",
+    "field_line_length_slider": create_interval_slider(
+        FIELD_LINE_LENGTH_INTERVAL, "Field Line Length"
     ),
     # Slider to set the allowed approach distance between a charge and field line
     # this is a logarithmic increment
-    "approach_tolerance_slider": bokeh.models.Slider(
-        start=APPROACH_TOLERANCE_INTERVAL[0],
-        end=APPROACH_TOLERANCE_INTERVAL[1],
-        value=APPROACH_TOLERANCE_INTERVAL[0] + APPROACH_TOLERANCE_INTERVAL[2],
-        step=APPROACH_TOLERANCE_INTERVAL[2],
-        title="Field Line to Charge Approach Tolerance",
+    "approach_tolerance_slider": create_interval_slider(
+        APPROACH_TOLERANCE_INTERVAL, "Field Line to Charge Approach Tolerance"
+    ),
+    # Toggle to trace field lines with adaptive rather than fixed size steps
+    "adaptive_step_toggle": bokeh.models.Toggle(
+        label="Adaptive Step Size", active=False
     ),
     # Variables to store the current values for each configurable
     "n_charges": N_CHARGES_INTERVAL[0] + N_CHARGES_INTERVAL[2],
@@ -118,8 +97,26 @@ application_data: typing.Dict[str, typing.Any] = {
     "field_line_length": FIELD_LINE_LENGTH_INTERVAL[0] + FIELD_LINE_LENGTH_INTERVAL[2],
     "approach_tolerance": APPROACH_TOLERANCE_INTERVAL[0]
     + APPROACH_TOLERANCE_INTERVAL[2],
+    "adaptive_step": False,
+    # The approach tolerance slider is a logarithmic increment, the tolerance itself
+    # is derived when the slider changes rather than on every update
+    "approach_tolerance_value": pow(
+        10, -(APPROACH_TOLERANCE_INTERVAL[0] + APPROACH_TOLERANCE_INTERVAL[2])
+    ),
+    # The most recently submitted field line calculation
+    "field_line_future": None,
+    # Whether an update of the plot has been scheduled but has not yet run
+    "update_pending": False,
+    # The charges and configuration shown by the most recent update of the plot
+    "plot_state": None,
 }
 
+# Field lines are calculated on a worker thread so the document is not locked while
+# lines are traced, the kernels release the GIL so this runs alongside the server
+_document = curdoc()
+_field_line_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+_document.on_session_destroyed(lambda _: _field_line_executor.shutdown(wait=False))
+
 # Create a new Bokeh Figure
 _figure = figure(
     x_range=(-15, 15), y_range=(-15, 15), title="Electric Field from Point Charges"
@@ -131,52 +128,145 @@ _charge_plots = {
     "-": _figure.scatter(x=[], y=[], fill_color="blue", size=15),
 }
 
-# Create the field line plot objects
-_field_line_plots = [
-    _figure.line()
-    for _ in range(FIELD_LINES_PER_CHARGE_INTERVAL[1] * N_CHARGES_INTERVAL[1])
-]
+# Create a single multi-line plot object holding all field lines
+_field_line_source = bokeh.models.ColumnDataSource({"xs": [], "ys": []})
+_figure.multi_line(xs="xs", ys="ys", source=_field_line_source)
+
+# Columns holding the widgets for each charge, extended as charges are added
+_charge_position_column = column()
+_polarity_column = column()
+
+
+@functools.lru_cache(maxsize=16)
+def cached_field_lines(
+    charge_positions: bytes,
+    charge_values: bytes,
+    field_lines_per_charge: int,
+    field_line_length: int,
+    n_points_per_unit_vector: int,
+    approach_tolerance: float,
+    adaptive_step: bool,
+) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """Calculate field lines, reusing the result for a previously seen configuration
+
+    Charge positions and values are given as the bytes of float64 arrays so the
+    configuration is hashable.
+    """
+    _field_lines, _field_line_lengths = mg_fl.field_line_buffer_from_arrays(
+        numpy.frombuffer(charge_positions, dtype=numpy.float64).reshape(-1, 3),
+        numpy.frombuffer(charge_values, dtype=numpy.float64),
+        field_lines_per_charge,
+        field_line_length,
+        n_points_per_unit_vector,
+        approach_tolerance,
+        adaptive_step,
+    )
 
+    # Split the x and y coordinates into contiguous planes of a single array, so
+    # each plotted line is a contiguous view rather than a strided column
+    _field_line_planes = numpy.ascontiguousarray(
+        numpy.moveaxis(_field_lines[:, :, :2], -1, 0)
+    )
 
-def update_plot() -> None:
-    application_data["charge_plot_data"] = {
-        "+": {"x": [], "y": []},
-        "-": {"x": [], "y": []},
+    return _field_line_planes, _field_line_lengths
+
+
+def plot_field_lines(future: concurrent.futures.Future) -> None:
+    """Plot the result of a field line calculation if it is the most recent"""
+    if future is not application_data["field_line_future"] or future.cancelled():
+        return
+
+    (_xs, _ys), _field_line_lengths = future.result()
+
+    # Update all field lines in a single assignment
+    application_data["field_line_plot_data"] = {
+        "xs": [x[:n_points] for x, n_points in zip(_xs, _field_line_lengths)],
+        "ys": [y[:n_points] for y, n_points in zip(_ys, _field_line_lengths)],
     }
+    _field_line_source.data = application_data["field_line_plot_data"]
+
+
+def set_scatter_data(
+    data_source: bokeh.models.ColumnDataSource, x: numpy.ndarray, y: numpy.ndarray
+) -> None:
+    """Set the points of a scatter plot, patching the existing points where possible
+
+    A patch only sends the new values to the client, the whole data is only replaced
+    when the number of points changes.
+    """
+    if len(data_source.data["x"]) != len(x):
+        data_source.data = {"x": x, "y": y}
+    elif len(x) > 0:
+        data_source.patch(
+            {"x": [(slice(len(x)), x.tolist())], "y": [(slice(len(y)), y.tolist())]}
+        )
+
 
-    for charge in application_data["charges"][: application_data["n_charges"]]:
-        _key: str = "+" if charge.charge > 0 else "-"
-        application_data["charge_plot_data"][_key]["x"].append(charge.position[0])
-        application_data["charge_plot_data"][_key]["y"].append(charge.position[1])
+def update_plot() -> None:
+    application_data["update_pending"] = False
+
+    _n_charges: int = application_data["n_charges"]
+    _charge_positions = application_data["charge_positions"][:_n_charges]
+    _charge_values = application_data["charge_values"][:_n_charges]
 
-    # Create the initial field lines and plot these
-    _field_lines = mg_fl.field_lines_from_charges(
-        application_data["charges"][: application_data["n_charges"]],
+    # The charge arrays are held as bytes so the worker has its own copy
+    _plot_state = (
+        _charge_positions.tobytes(),
+        _charge_values.tobytes(),
         application_data["field_lines_per_charge"],
         application_data["field_line_length"],
         application_data["n_points_per_unit_vector"],
-        pow(10, -application_data["approach_tolerance"]),
+        application_data["approach_tolerance_value"],
+        application_data["adaptive_step"],
     )
 
-    application_data["field_line_plot_data"] = [
-        {"x": f[:, 0], "y": f[:, 1]} for f in _field_lines
-    ]
-    application_data["field_line_plot_data"] += [
-        {"x": [], "y": []} for _ in range(len(_field_line_plots) - len(_field_lines))
-    ]
+    # Nothing which is plotted has changed since the last update
+    if _plot_state == application_data["plot_state"]:
+        return
+    application_data["plot_state"] = _plot_state
 
-    for i, field_line in enumerate(application_data["field_line_plot_data"]):
-        _field_line_plots[i].data_source.data = field_line
+    # Submit the field line calculation, superseding any which has not yet started
+    if application_data["field_line_future"] is not None:
+        application_data["field_line_future"].cancel()
 
-    # Plot the charges as a scatter graph
-    for polarity in application_data["charge_plot_data"].keys():
-        _charge_plots[polarity].data_source.data = application_data["charge_plot_data"][
-            polarity
-        ]
+    application_data["field_line_future"] = _field_line_executor.submit(
+        cached_field_lines, *_plot_state
+    )
+    application_data["field_line_future"].add_done_callback(
+        lambda future: _document.add_next_tick_callback(
+            functools.partial(plot_field_lines, future)
+        )
+    )
+
+    # Plot the charges as a scatter graph, split by polarity. Holding the document
+    # sends both changes to the client as a single message
+    _positive = _charge_values > 0
+    _document.hold("combine")
+    try:
+        set_scatter_data(
+            _charge_plots["+"].data_source,
+            _charge_positions[_positive, 0],
+            _charge_positions[_positive, 1],
+        )
+        set_scatter_data(
+            _charge_plots["-"].data_source,
+            _charge_positions[~_positive, 0],
+            _charge_positions[~_positive, 1],
+        )
+    finally:
+        _document.unhold()
+
+
+def schedule_update_plot() -> None:
+    """Schedule an update of the plot, combining any further requests made before it runs"""
+    if application_data["update_pending"]:
+        return
+    application_data["update_pending"] = True
+    _document.add_timeout_callback(update_plot, UPDATE_DEBOUNCE_PERIOD)
 
 
 def hide_widgets_above_index(index: int) -> None:
-    for i, _ in enumerate(application_data["charges"]):
+    for i, _ in enumerate(application_data["polarity_checkboxes"]):
         application_data["charge_position_sliders"]["x"][i].visible = i < index
         application_data["charge_position_sliders"]["y"][i].visible = i < index
         application_data["polarity_checkboxes"][i].visible = i < index
@@ -188,28 +278,30 @@ def gen_charge_position_callback(
     """Create the callback for setting the charge position"""
 
     def charge_position_callback(attr, old, new) -> None:
-        application_data["charges"][charge_index].position[vector_index] = new
-        loguru.logger.debug(f"Set charge {charge_index} position to {application_data['charges'][charge_index].position}")
-        update_plot()
+        application_data["charge_positions"][charge_index, vector_index] = new
+        loguru.logger.debug(f"Set charge {charge_index} position to {application_data['charge_positions'][charge_index]}")
+        schedule_update_plot()
 
     return charge_position_callback
 
 
 def gen_polarity_callback(charge_index: int) -> None:
     def polarity_callback(attr, old, new) -> None:
-        application_data["charges"][charge_index].charge = 1 if new == 1 else -1
-        loguru.logger.debug(f"Set charge {charge_index} charge to {application_data['charges'][charge_index].charge}")
-        update_plot()
+        application_data["charge_values"][charge_index] = 1 if new == 1 else -1
+        loguru.logger.debug(f"Set charge {charge_index} charge to {application_data['charge_values'][charge_index]}")
+        schedule_update_plot()
 
     return polarity_callback
 
 
 def n_charges_callback(attr, old, new) -> None:
     """Create the callback for defining the number of charges"""
+    for i in range(len(application_data["polarity_checkboxes"]), new):
+        create_charge_widgets(i)
     hide_widgets_above_index(new)
     application_data["n_charges"] = new
     loguru.logger.debug(f"Set number of charges to {new}")
-    update_plot()
+    schedule_update_plot()
 
 
 def gen_config_callback(value_label: str) -> typing.Callable:
@@ -217,23 +309,51 @@ def gen_config_callback(value_label: str) -> typing.Callable:
 
     def config_callback(attr, old, new) -> None:
         application_data[value_label] = new
+        if value_label == "approach_tolerance":
+            application_data["approach_tolerance_value"] = pow(10, -new)
         loguru.logger.debug(f"Set {value_label} to {new}")
-        update_plot()
+        schedule_update_plot()
 
     return config_callback
 
 
-# Assign the sliders to the update of position for each of the charges
-for i, slider in enumerate(application_data["charge_position_sliders"]["x"]):
-    slider.on_change("value", gen_charge_position_callback(i, 0))
+def create_charge_widgets(charge_index: int) -> None:
+    """Create the position sliders and polarity check box for a charge"""
+    _position_sliders = []
 
-for i, slider in enumerate(application_data["charge_position_sliders"]["y"]):
-    slider.on_change("value", gen_charge_position_callback(i, 1))
+    for vector_index, label in enumerate(("x", "y")):
+        _slider = bokeh.models.Slider(
+            start=-10,
+            end=10,
+            value=float(
+                application_data["charge_positions"][charge_index, vector_index]
+            ),
+            step=1,
+            title=f"Q{charge_index}{label}",
+        )
+
+        # Sliders only fire on release to avoid recalculating during a drag
+        _slider.on_change(
+            "value_throttled", gen_charge_position_callback(charge_index, vector_index)
+        )
+        application_data["charge_position_sliders"][label].append(_slider)
+        _position_sliders.append(_slider)
+
+    _checkbox = bokeh.models.RadioButtonGroup(
+        labels=["-", "+"],
+        active=1 if application_data["charge_values"][charge_index] > 0 else 0,
+        orientation="vertical",
+    )
+    _checkbox.on_change("active", gen_polarity_callback(charge_index))
+    application_data["polarity_checkboxes"].append(_checkbox)
+
+    _charge_position_column.children.extend(_position_sliders)
+    _polarity_column.children.append(_checkbox)
 
 
-# Assign checkbox callbacks
-for i, checkbox in enumerate(application_data["polarity_checkboxes"]):
-    checkbox.on_change("active", gen_polarity_callback(i))
+# Create the widgets for the charges shown initially
+for i in range(application_data["n_charges"]):
+    create_charge_widgets(i)
 
 
 # Assign the callbacks for the configurables
@@ -244,38 +364,30 @@ for configurable in {
     "approach_tolerance",
 }:
     application_data[f"{configurable}_slider"].on_change(
-        "value", gen_config_callback(configurable)
+        "value_throttled", gen_config_callback(configurable)
     )
 
-application_data["n_charges_slider"].on_change("value", n_charges_callback)
+application_data["n_charges_slider"].on_change("value_throttled", n_charges_callback)
+application_data["adaptive_step_toggle"].on_change(
+    "active", gen_config_callback("adaptive_step")
+)
 
 
 # Update the plot before displaying application
-hide_widgets_above_index(application_data["n_charges"])
 update_plot()
 
-# Setup the layout of the widgets on the screen before displaying them
-_positions_slider_arrangement = []
-
-for i, _ in enumerate(application_data["charge_position_sliders"]["x"]):
-    _positions_slider_arrangement.append(
-        application_data["charge_position_sliders"]["x"][i]
-    )
-    _positions_slider_arrangement.append(
-        application_data["charge_position_sliders"]["y"][i]
-    )
-
 # Add all objects to the application
 curdoc().add_root(
     row(
-        column(*_positions_slider_arrangement),
-        column(*application_data["polarity_checkboxes"]),
+        _charge_position_column,
+        _polarity_column,
         column(
             application_data["n_charges_slider"],
             application_data["field_line_length_slider"],
             application_data["field_lines_per_charge_slider"],
             application_data["n_points_per_unit_vector_slider"],
             application_data["approach_tolerance_slider"],
+            application_data["adaptive_step_toggle"],
         ),
         _figure,
     )